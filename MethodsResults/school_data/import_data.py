@@ -6,6 +6,10 @@ import numpy as np
 from pandas import ExcelWriter
 from pandas import ExcelFile
 import re
+import os
+import hashlib
+import tempfile
+from pkg_resources import resource_filename
 from ethnicolr import census_ln, pred_census_ln, pred_wiki_ln, pred_wiki_name, pred_fl_reg_name
 import recordlinkage as rl
 
@@ -14,6 +18,8 @@ RETENTION = "retention_rates.xls"
 RETENTION_CLEAN = "retention_manual_cleaned.xlsx"
 STUDENT_RACE = "demo_stdnt_race_2018.xls"
 STUDENT_SPED_ELL_T1 = "demo_sped_ell_lunch_2018.xls"
+CENSUS_INDEX = "census_ln_{}_{}_index.npy"
+CENSUS_RACES = ['white', 'black', 'api', 'hispanic']
 
 
 def build_final_dataset():
@@ -229,6 +235,11 @@ def initial_race_impute():
 	each race to the dataframe and assign a "final race" to be used
 	in the modeling process based on the greatest probability.
 
+	Only the census vote uses the Census surname index fast path, so
+	exact census hits skip one of the three model calls. The wiki and
+	Florida votes still run their models on every teacher, to keep the
+	three votes independent, so this is not a dictionary-lookup speedup.
+
 	Input: None
 	Output:
 		- df: a dataframe with four new columns attached that include 
@@ -296,8 +307,28 @@ def run_pred_census_ln (subset_df, census_year):
     Output:
     	- df: a dataframe with a predicted race imputation 
     """
-    has_last_name_df = subset_df[subset_df.teacher_last.notnull()].copy() 
-    df = pred_census_ln(has_last_name_df, 'teacher_last', census_year)
+    # skip missing and blank surnames, which the model would drop
+    has_last_name = subset_df.teacher_last.notnull() & \
+        (subset_df.teacher_last.astype(str).str.strip() != '')
+    has_last_name_df = subset_df[has_last_name].copy() 
+
+    # resolve exact surname hits from the census index first
+    index = load_census_index(census_year)
+    has_last_name_df['race'] = lookup_census_race(has_last_name_df.teacher_last, index)
+
+    # only run the model on surnames missing from the census table,
+    # matching its results back to teachers by row key, not position
+    has_last_name_df['row_key'] = np.arange(len(has_last_name_df))
+    miss = has_last_name_df.race.isnull()
+    if miss.any():
+        miss_df = pred_census_ln(has_last_name_df[miss].drop('race', axis=1), 
+            'teacher_last', census_year)
+        if len(miss_df) != miss.sum():
+            raise ValueError("pred_census_ln returned {} rows for {} surnames".format(
+                len(miss_df), miss.sum()))
+        model_race = miss_df.drop_duplicates('row_key').set_index('row_key')['race']
+        has_last_name_df.loc[miss, 'race'] = has_last_name_df.loc[miss, 'row_key'].map(model_race)
+    df = has_last_name_df.drop('row_key', axis=1)
     
     #recode two race categories
     recode_dict = {'api': 'asian'}
@@ -313,6 +344,127 @@ def run_pred_census_ln (subset_df, census_year):
     return df
 
 
+def build_census_index(census_year):
+	"""
+	This function builds a hash index over the Census surname table that
+	ships with ethnicolr and saves it to a .npy file. Each entry holds
+	the hash of a surname and the code of its most common race, sorted
+	by hash so that lookups can use a binary search.
+
+	Input:
+		- census_year: the year of the Census surname table (2000 or 2010)
+	Output:
+		- filename: a string name of the saved index file
+	"""
+	filename, census_file = census_index_filename(census_year)
+	pct_cols = ['pct' + race for race in CENSUS_RACES]
+	# read names as-is so real surnames like "NULL" and "NAN" are kept
+	df = pd.read_csv(census_file, usecols=['name'] + pct_cols, 
+		dtype={'name': str}, keep_default_na=False)
+
+	# suppressed percentages are stored as "(S)"
+	pct_df = df[pct_cols].apply(pd.to_numeric, errors='coerce')
+	has_pct = pct_df.notnull().any(axis=1)
+	df, pct_df = df[has_pct], pct_df[has_pct]
+
+	# store the hash and race code of each surname, sorted by hash
+	index = np.empty(len(df), dtype=[('key', '<u8'), ('race', 'u1')])
+	index['key'] = hash_surnames(df.name)
+	index['race'] = pct_df.fillna(-1.0).values.argmax(axis=1)
+	index.sort(order='key')
+	if len(np.unique(index['key'])) != len(index):
+		raise ValueError("census surname index has duplicate keys")
+
+	# write to a temporary file first so a partial index is never loaded
+	fd, tmp_filename = tempfile.mkstemp(suffix='.npy', 
+		dir=os.path.dirname(os.path.abspath(filename)))
+	try:
+		with os.fdopen(fd, 'wb') as f:
+			np.save(f, index)
+		os.replace(tmp_filename, filename)
+	except BaseException:
+		os.remove(tmp_filename)
+		raise
+
+	return filename
+
+
+def census_index_filename(census_year):
+	"""
+	This is a helper function that names the Census surname index file
+	after the race codes and the size and modification time of the
+	source CSV, so the index is rebuilt whenever either one changes
+
+	Input:
+		- census_year: the year of the Census surname table (2000 or 2010)
+	Output:
+		- filename: a string name of the index file
+		- census_file: a string path of the source Census CSV
+	"""
+	census_file = resource_filename('ethnicolr', 
+		'data/census/census_{}.csv'.format(census_year))
+	stat = os.stat(census_file)
+	source = '{}|{}|{}'.format(','.join(CENSUS_RACES), stat.st_size, stat.st_mtime_ns)
+	tag = hashlib.md5(source.encode('utf-8')).hexdigest()[:12]
+	filename = CENSUS_INDEX.format(census_year, tag)
+
+	return filename, census_file
+
+
+def load_census_index(census_year):
+	"""
+	This function loads the Census surname index as a memory-mapped
+	array, building it first if the index file does not exist yet.
+
+	Input:
+		- census_year: the year of the Census surname table (2000 or 2010)
+	Output:
+		- index: a memory-mapped numpy array of surname hashes and race codes
+	"""
+	filename, _ = census_index_filename(census_year)
+	if not os.path.exists(filename):
+		build_census_index(census_year)
+	index = np.load(filename, mmap_mode='r')
+
+	return index
+
+
+def lookup_census_race(surnames, index):
+	"""
+	This function resolves surnames that exactly match an entry in the
+	Census surname index to that entry's most common race.
+
+	Input:
+		- surnames: a pandas series of last names
+		- index: a Census surname index from load_census_index
+	Output:
+		- se: a pandas series of races, None where the surname was not found
+	"""
+	keys = hash_surnames(surnames)
+	pos = np.searchsorted(index['key'], keys)
+	pos[pos == len(index)] = 0
+	hit = index['key'][pos] == keys
+
+	races = np.array(CENSUS_RACES, dtype=object)[index['race'][pos]]
+	se = pd.Series(np.where(hit, races, None), index=surnames.index)
+
+	return se
+
+
+def hash_surnames(surnames):
+	"""
+	This is a helper function that hashes upper-cased surnames into
+	unsigned 64-bit integers, matching the Census name format
+	"""
+	if surnames.isnull().any():
+		raise ValueError("cannot hash missing surnames")
+	names = surnames.astype(str).str.strip().str.upper()
+	keys = [int.from_bytes(hashlib.md5(n.encode('utf-8')).digest()[:8], 'little') 
+		for n in names]
+
+	return np.array(keys, dtype='<u8')
+
+
 def run_pred_wiki_ln (subset_df):
     """
     This function takes a dataframe of teacher information and
@@ -616,21 +768,16 @@ def import_student_sped_ell(filename):
 		- df: a pandas dataframe
 	"""
 	df = pd.read_excel(filename, skiprows=1, sheetname='Schools', 
-		usecols=[1,5,7,9])
-	df.drop([0,661,662,663], inplace=True)
+		usecols=[1,2,5,7,9])
+	df = drop_summary_rows(df, 'School ID')
 	df.set_index('School ID', inplace=True)
 	df.rename(index=int, columns={'%': 'ell', '%.1': 'sped', '%.2': 'free_lunch'}, inplace=True)
 	df.index.names = ['ID']
-	
-	# average for demographics for high schools in CPS (manually calculated)
-	ell_avg = 8.475
-	sped_avg = 15.775
-	free_lunch_avg = 82.75
 
-	# fillna with averages from demographics
-	df['ell'].fillna(value=ell_avg, inplace=True)
-	df['sped'].fillna(value=sped_avg, inplace=True)
-	df['free_lunch'].fillna(value=free_lunch_avg, inplace=True)
+	# fillna with averages from schools of the same type
+	df['school_type'] = df['School Name'].apply(get_school_type)
+	df = impute_group_means(df, ['ell', 'sped', 'free_lunch'], by='school_type')
+	df.drop(['School Name', 'school_type'], axis=1, inplace=True)
 
 	return df
 
@@ -647,33 +794,78 @@ def import_student_race(filename):
 		- df: a pandas dataframe
 	"""
 	df = pd.read_excel(filename, skiprows=1, sheetname='Schools', 
-		usecols=[0,5,7,11,13,15,17,19,21])
-	df.drop([0], inplace=True)
+		usecols=[0,1,5,7,11,13,15,17,19,21])
+	df = drop_summary_rows(df, 'School ID')
 	df.set_index('School ID', inplace=True)
 	df.rename(index=int, columns={'Pct': 'white', 'Pct.1': 'black',
 		'Pct.3': 'nat_am_alsk', 'Pct.4': 'hispanic', 'Pct.5': 'multi', 'Pct.6': 'asian',
 		'Pct.7': 'hi_pi', 'Pct.8': 'unknown'}, inplace=True)
 	df.index.names = ['ID']
 
-	# average for demographics for high schools in CPS
-	white_avg = 8.6
-	black_avg = 38.3
-	nat_am_alsk_avg = 0.3
-	hispanic_avg = 47.2
-	multi_avg = 1.0
-	asian_avg = 4.0
-	hi_pi_avg = 0.1
-	unknown_avg = 0.5
-
-	# fillna with district averages
-	df['white'].fillna(value=white_avg, inplace=True)
-	df['black'].fillna(value=black_avg, inplace=True)
-	df['nat_am_alsk'].fillna(value=nat_am_alsk_avg, inplace=True)
-	df['hispanic'].fillna(value=hispanic_avg, inplace=True)
-	df['multi'].fillna(value=multi_avg, inplace=True)
-	df['asian'].fillna(value=asian_avg, inplace=True)
-	df['hi_pi'].fillna(value=hi_pi_avg, inplace=True)
-	df['unknown'].fillna(value=unknown_avg, inplace=True)
+	# fillna with averages from schools of the same type
+	df['school_type'] = df['School Name'].apply(get_school_type)
+	df = impute_group_means(df, ['white', 'black', 'nat_am_alsk', 'hispanic',
+		'multi', 'asian', 'hi_pi', 'unknown'], by='school_type')
+	df.drop(['School Name', 'school_type'], axis=1, inplace=True)
+
+	return df
+
+
+def get_school_type(name):
+	"""
+	This is a helper function that labels a school as a high school or
+	not based on its name, since the Network column mixes both types
+	"""
+	if re.search(r"HS\b|High School", str(name)):
+		return 'high_school'
+
+	return 'other'
+
+
+def drop_summary_rows(df, id_col):
+	"""
+	This function drops the sub-header, footer, and summary rows of a
+	school-level sheet. A row is kept only if it has a numeric school ID,
+	so totals and notes are removed wherever they appear in the sheet.
+
+	Input:
+		- df: a pandas dataframe imported from excel
+		- id_col: a string name of the school ID column
+	Output:
+		- df: a pandas dataframe with only school rows
+	"""
+	ids = pd.to_numeric(df[id_col], errors='coerce')
+	df = df[ids.notnull()].copy()
+	df[id_col] = ids[ids.notnull()].astype(int)
 
 	return df
 
+
+def impute_group_means(df, cols, by=None):
+	"""
+	This function fills the missing values of the given columns with
+	their averages, computed from the data itself. The averages are
+	taken over the whole dataframe, or within each group if a grouping
+	column (e.g. district, school type, or year) is given. Rows with a
+	missing group, or in a group with no values, get the overall mean.
+
+	Input:
+		- df: a pandas dataframe
+		- cols: a list of column names to impute
+		- by: optional column name(s) to group by before averaging
+	Output:
+		- df: a pandas dataframe with the missing values filled
+	"""
+	df = df.copy()
+	values = df[cols].apply(pd.to_numeric, errors='coerce')
+
+	# compute all averages in one pass and broadcast them onto the rows
+	if by is None:
+		means = values.mean()
+	else:
+		means = values.groupby([df[c] for c in np.atleast_1d(by)]).transform('mean')
+
+	# fall back to the overall mean for missing or all-empty groups
+	df[cols] = values.fillna(means).fillna(values.mean())
+
+	return df